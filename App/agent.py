@@ -40,7 +40,8 @@ class Agent():
             - action (Type: int corresponding to action in env.action_space)
         Returns:
             - envState (Type: dict containing all information to be recorded for future use)
-              change contents of dict as desired, but return must be type dict.
+              change contents of dict as desired, but return must be type dict
+              and its values must be msgpack serializable (numpy arrays are).
         '''
         observation, reward, done, info = self.env.step(action)
         envState = {'observation': observation, 'reward': reward, 'done': done, 'info': info}
@@ -50,12 +51,16 @@ class Agent():
         '''
         Gets render from gym.
         Caller:
+            - Trial.run()
             - Trial.get_render()
         Inputs:
             - env (Type: OpenAI gym Environment)
         Returns:
             - return from env.render('rgb_array') (Type: npArray)
               must return the unchanged rgb_array
+              The array is encoded on another thread while step() runs, so
+              it must not be modified by step(). If the environment reuses
+              its render buffer, return a copy instead.
         '''
         return self.env.render('rgb_array')
     
@@ -1,5 +1,6 @@
-import asyncio, websockets, json, sys, pathlib, ssl
-from trial import Trial
+import asyncio, websockets, orjson, sys, pathlib, ssl, pybase64
+from trial import Trial, load_config
+from framering import FrameRing
 from multiprocessing import Process, Pipe
 from s3upload import Uploader
 import logging
@@ -20,6 +21,7 @@ def main():
     global ADDRESS
     global PORT
     global devEnv
+    load_config() # parse the trial config once so each Trial process inherits it
     if len(sys.argv) > 1 and sys.argv[1] == 'dev':
         start_server = websockets.serve(handler, ADDRESS, PORT)
         devEnv = True
@@ -36,10 +38,11 @@ async def handler(websocket, path):
     Then starts async listeners for sending and recieving messages.
     '''
     upPipe, downPipe = Pipe()
-    userTrial = Process(target=Trial, args=(downPipe,))
+    frames = FrameRing()
+    userTrial = Process(target=Trial, args=(downPipe, frames))
     userTrial.start()
     consumerTask = asyncio.ensure_future(consumer_handler(websocket, upPipe))
-    producerTask = asyncio.ensure_future(producer_handler(websocket, upPipe))
+    producerTask = asyncio.ensure_future(producer_handler(websocket, upPipe, frames))
     done, pending = await asyncio.wait(
         [consumerTask, producerTask],
         return_when = asyncio.FIRST_COMPLETED
@@ -56,7 +59,7 @@ async def consumer_handler(websocket, pipe):
     async for message in websocket:
         pipe.send(message)
 
-async def producer_handler(websocket, pipe):
+async def producer_handler(websocket, pipe, frames):
     '''
     Loop to call producer for messages to send from userTrial process.
     Note that asyncio.sleep() is required to make this non-blocking
@@ -69,11 +72,11 @@ async def producer_handler(websocket, pipe):
     '''
     done = False
     while True:
-        done = await producer(websocket, pipe)
+        done = await producer(websocket, pipe, frames)
         await asyncio.sleep(0.01)
     return
 
-async def producer(websocket, pipe):
+async def producer(websocket, pipe, frames):
     '''
     Check userTrial process pipe for messages to send to websocket.
     If userTrial is done, send final message to websocket and return
@@ -84,12 +87,29 @@ async def producer(websocket, pipe):
         if message == 'done':
             await websocket.send('done')
             return True
+        elif isinstance(message, dict) and 'frameId' in message:
+            render = render_message(message, frames)
+            if render:
+                await websocket.send(render)
         elif 'upload' in message:
             await upload_to_s3(message)
         else:
             await websocket.send(message)
     return False
 
+def render_message(message, frames):
+    '''
+    Builds the render message for the websocket from a frame sent by
+    userTrial, either inline or as a FrameRing slot. Binary frames are sent
+    as the raw jpeg bytes, otherwise as json with the frame base64 encoded.
+    Returns None if the slot was reused for a newer frame before it could
+    be read.
+    '''
+    frame = message.get('frame') or frames.read(message['frameId'], message['slot'], message['len'])
+    if frame is None or message.get('binary'):
+        return frame
+    return orjson.dumps({'frame': pybase64.b64encode(frame).decode('ascii'), 'frameId': message['frameId']}).decode('utf-8')
+
 async def upload_to_s3(message):
     global devEnv
     logging.info(devEnv)
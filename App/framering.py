@@ -0,0 +1,58 @@
+'''
+Shared memory ring buffer used to pass rendered jpeg frames from a Trial
+process to the communicator without pickling them through the Pipe. The
+Trial writes each frame into the next slot and only sends a small header
+with the slot location over the Pipe.
+'''
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+
+SLOTS = 4 # number of frames that can be waiting to be sent at once
+SLOT_SIZE = 1 << 20 # bytes per slot, larger frames are sent through the Pipe
+STAMP_SIZE = ctypes.sizeof(ctypes.c_uint64)
+
+class FrameRing():
+    '''
+    Each slot starts with the frameId of the frame it holds. The stamp is
+    cleared while a frame is being written so that the reader can tell when
+    a slot has been reused for a newer frame before it was sent.
+    '''
+
+    def __init__(self, slots:int=SLOTS, slotSize:int=SLOT_SIZE):
+        self.slots = slots
+        self.slotSize = slotSize
+        self.buffer = RawArray(ctypes.c_ubyte, slots * slotSize)
+        self.nextSlot = 0
+
+    def write(self, frameId:int, frame):
+        '''
+        Copies a jpeg frame into the next slot, stamped with its frameId.
+        Returns the slot index, or None if the frame does not fit in a slot.
+        '''
+        length = len(frame)
+        if length > self.slotSize - STAMP_SIZE:
+            return None
+        slot = self.nextSlot
+        self.nextSlot = (slot + 1) % self.slots
+        offset = slot * self.slotSize
+        stamp = ctypes.c_uint64.from_buffer(self.buffer, offset)
+        stamp.value = 0
+        start = offset + STAMP_SIZE
+        memoryview(self.buffer).cast('B')[start:start + length] = frame
+        stamp.value = frameId
+        return slot
+
+    def read(self, frameId:int, slot:int, length:int):
+        '''
+        Copies a frame out of its slot. Returns None if the slot has been
+        reused for a newer frame in the meantime.
+        '''
+        offset = slot * self.slotSize
+        stamp = ctypes.c_uint64.from_buffer(self.buffer, offset)
+        if stamp.value != frameId:
+            return None
+        start = offset + STAMP_SIZE
+        frame = bytes(memoryview(self.buffer).cast('B')[start:start + length])
+        if stamp.value != frameId:
+            return None
+        return frame
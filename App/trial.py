@@ -1,27 +1,101 @@
-import numpy, json, shortuuid, time, base64, yaml, logging
-import _pickle as cPickle
+import numpy, orjson, ormsgpack, shortuuid, time, yaml, logging, selectors, os
 from PIL import Image
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_RGBA, TJPF_GRAY, TJSAMP_420, TJSAMP_GRAY
+    TJ_PIXEL_FORMATS = {3: TJPF_RGB, 4: TJPF_RGBA} # colour channels -> libjpeg-turbo pixel format
+except ImportError:
+    TurboJPEG = None # frames are encoded with Pillow instead
 from agent import Agent # this is the Agent/Environment compo provided by the researcher
 
+CONFIG_FILE = '.trialConfig.yml'
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader) # libyaml parser if available
+_config_cache = {} # mtime -> parsed trial config
+DEFAULT_UI = ['left','right','up','down','start','pause']
+MAX_MESSAGES_PER_FRAME = 8 # bounds the websocket messages handled between two steps
+
 def load_config():
-    logging.info('Loading Config in trial.py')
-    with open('.trialConfig.yml', 'r') as infile:
-        config = yaml.load(infile, Loader=yaml.FullLoader)
-    logging.info('Config loaded in trial.py')
-    return config.get('trial')
+    '''
+    Returns the trial config, only parsing the yaml file again if it has been
+    modified since it was last loaded. The communicator loads it once at
+    startup so every forked Trial process inherits the parsed config.
+    '''
+    mtime = os.stat(CONFIG_FILE).st_mtime_ns
+    if mtime not in _config_cache:
+        logging.info('Loading Config in trial.py')
+        with open(CONFIG_FILE, 'r') as infile:
+            config = yaml.load(infile, Loader=YAML_LOADER)
+        _config_cache.clear()
+        _config_cache[mtime] = config.get('trial')
+        logging.info('Config loaded in trial.py')
+    return _config_cache[mtime]
+
+def load_turbojpeg():
+    '''
+    Returns a TurboJPEG encoder, or None if PyTurboJPEG or the libturbojpeg
+    shared library is not installed, in which case Pillow is used.
+    '''
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except (OSError, RuntimeError):
+        logging.info('libturbojpeg not found, encoding frames with Pillow')
+        return None
+
+def to_image(render):
+    '''
+    Wraps a C-contiguous uint8 npArray in a PIL Image. Greyscale and 4 channel
+    renders are mapped so the Image shares memory with the array, 4 channel
+    renders as RGBX so the alpha channel is ignored when saving as jpeg.
+    Pillow cannot map 3 channel RGB memory, so those are still copied.
+    '''
+    height, width = render.shape[:2]
+    if render.ndim == 2:
+        return Image.frombuffer('L', (width, height), render, 'raw', 'L', 0, 1)
+    if render.shape[2] == 4:
+        return Image.frombuffer('RGBX', (width, height), render, 'raw', 'RGBX', 0, 1)
+    return Image.fromarray(render)
+
+def pack_default(obj):
+    '''
+    Fallback for objects ormsgpack cannot serialize natively. Numpy scalars
+    and non-contiguous arrays are converted to python numbers and lists.
+    Anything else raises a TypeError, everything returned by Agent.step()
+    and sent from the websocket must be msgpack serializable.
+    '''
+    if isinstance(obj, (numpy.generic, numpy.ndarray)):
+        return obj.tolist()
+    raise TypeError(f'{type(obj).__name__} is not msgpack serializable, envState values must be')
+
+def pack_record(record):
+    '''
+    Serializes a log record with msgpack. Numpy arrays such as observations
+    are written natively. Records are appended to the outfile one after
+    another and can be read back with a streaming msgpack.Unpacker.
+    '''
+    return ormsgpack.packb(record, default=pack_default, option=ormsgpack.OPT_SERIALIZE_NUMPY)
 
 class Trial():
     
-    def __init__(self, pipe):
+    def __init__(self, pipe, frames):
         self.config = load_config()
         self.pipe = pipe
+        self.frames = frames
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(pipe, selectors.EVENT_READ)
+        self.handlers = {
+            'command': self.handle_command,
+            'changeFrameRate': self.handle_framerate_change,
+            'action': self.handle_action,
+        } # in order of priority, only the first key present in a message is handled
         self.frameId = 0
-        self.humanAction = self.config.get('actionSpace').index('noop') # Initialise with noop action 
+        self.actionCodes = {action: code for code, action in enumerate(self.config.get('actionSpace'))}
+        self.humanAction = self.actionCodes['noop'] # Initialise with noop action 
         self.episode = 0
         self.done = False
         self.play = False
-        self.trial_log = []
         self.ep_log = []
         self.trialId = shortuuid.uuid()
         self.outfile = None
@@ -30,10 +104,36 @@ class Trial():
         self.projectId = self.config.get('projectId')
         self.filename = None
         self.path = None
+        self._tj = load_turbojpeg()
+        self._fp = BytesIO()
+        self.encoder = ThreadPoolExecutor(max_workers=1)
+        self.cache_config()
 
         self.start()
         self.run()
 
+    def cache_config(self):
+        '''
+        Copies config values that are read every frame or step into attributes
+        so the hot paths do not repeat the dict lookups.
+        '''
+        self.dataFile = self.config.get('dataFile')
+        self.s3upload = self.config.get('s3upload')
+        self.bucket = self.config.get('bucket')
+        self.maxEpisodes = self.config.get('maxEpisodes', 20)
+        self.jpegQuality = self.config.get('jpegQuality', 75)
+        self.maxRenderSide = self.config.get('maxRenderSide')
+        self.binaryFrames = self.config.get('binaryFrames', False)
+        self.allowFrameRateChange = self.config.get('allowFrameRateChange')
+        self.minFrameRate = self.config.get('minFrameRate', 1)
+        self.maxFrameRate = self.config.get('maxFrameRate', 90)
+        step = self.config.get('frameRateStepSize', 5)
+        self.frameRateSteps = {'faster': step, 'slower': -step}
+        try:
+            self.uiMessage = orjson.dumps({'UI': self.config.get('ui', DEFAULT_UI)}).decode('utf-8')
+        except:
+            raise TypeError("UI config is not JSON serializable")
+
     def start(self):
         '''
         Call the function in the Agent/Environment combo required to start 
@@ -48,34 +148,42 @@ class Trial():
     def run(self):
         '''
         This is the main event controlling function for a Trial. 
-        It handles the render-step loop
+        It handles the render-step loop. Each iteration sleeps only until the
+        next frame deadline so time spent rendering and stepping is not added
+        on top of the framerate. The frame is encoded on the encoder thread
+        while the step is taken, reading the render array in place, so the
+        Agent must not modify a returned render during step().
         '''
+        nextTick = time.monotonic()
         while not self.done:
-            message = self.check_message()
-            if message:
-                self.handle_message(message)
+            for message in self.check_message():
+                if message:
+                    self.handle_message(message)
+                if self.done:
+                    break
             if self.play:
-                render = self.get_render()
-                self.send_render(render)
+                encoding = self.encoder.submit(self.encode_frame, self.agent.render())
                 self.take_step()
-            time.sleep(1/self.framerate)
+                if not self.done:
+                    self.send_render(self.get_render(encoding))
+            nextTick += 1/self.framerate
+            delay = nextTick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                nextTick = time.monotonic()
 
     def reset(self):
         '''
         Resets the OpenAI gym environment to start a new episode.
         By default this function will create a new log file for every
-        episode, if the intention is to log only full trials then
-        comment the 3 lines below contianing self.outfile and 
-        self.create_file.
+        episode, if dataFile is set to 'trial' the same file is kept open
+        for the whole trial.
         '''
         if self.check_trial_done():
             self.end()
         else:
             self.agent.reset()
-            if self.outfile:
-                self.outfile.close()
-                if self.config.get('s3upload'):
-                    self.pipe.send({'upload':{'projectId':self.projectId ,'userId':self.userId,'file':self.filename,'path':self.path, 'bucket': self.config.get('bucket')}})
             self.create_file()
             self.episode += 1
 
@@ -84,44 +192,52 @@ class Trial():
         Checks if the trial has been completed and can be quit. Add conditions
         as required.
         '''
-        return self.episode >= self.config.get('maxEpisodes', 20)
+        return self.episode >= self.maxEpisodes
 
     def end(self):
         '''
         Closes the environment through the agent, closes any remaining outfile
-        and sends the 'done' message to the websocket pipe. If logging the 
-        whole trial memory in self.trial_log, uncomment the call to self.save_record()
-        to write the record to file before closing.
+        and sends the 'done' message to the websocket pipe. Episodes are
+        already written to the outfile as they complete. The outfile is
+        closed first so its upload message is sent before 'done'.
         '''
+        self.close_file()
         self.pipe.send('done')
         self.agent.close()
-        if self.config.get('dataFile') == 'trial':
-            self.save_record()
-        if self.outfile:
-            self.outfile.close()
-            self.pipe.send({'upload':{'projectId':self.projectId,'userId':self.userId,'file':self.filename,'path':self.path}})
+        self.encoder.shutdown(wait=False)
+        self.selector.close()
         self.play = False
         self.done = True
 
     def check_message(self):
         '''
         Checks pipe for messages from websocket, tries to parse message from
-        json. Retruns message or error message if unable to parse json.
+        json. Yields the messages waiting in the pipe, up to
+        MAX_MESSAGES_PER_FRAME so a flood of messages cannot stall the
+        render-step loop, or an error message for each one unable to be
+        parsed from json into a dictionary. Any remaining messages are
+        handled in the following frames.
+        Each action overwrites self.humanAction, so only the last action
+        handled in a frame reaches take_step(). Earlier ones are still
+        logged in self.ep_log.
         Expects some poorly formatted or incomplete messages.
         '''
-        if self.pipe.poll():
+        for _ in range(MAX_MESSAGES_PER_FRAME):
+            if not self.selector.select(0):
+                return
             message = self.pipe.recv()
             try:
-                message = json.loads(message)
+                message = orjson.loads(message)
             except:
+                message = None
+            if not isinstance(message, dict):
                 message = {'error': 'unable to parse message', 'frameId': self.frameId}
-            return message
-        return None
+            yield message
 
     def handle_message(self, message:dict):
         '''
         Reads messages sent from websocket, handles commands as priority then 
-        actions. Logs entire message in self.ep_log
+        actions using self.handlers. Logs entire message in self.ep_log
         '''
         if not self.userId and 'userId' in message:
             self.userId = message['userId'] or f'user_{shortuuid.uuid()}'
@@ -129,13 +245,11 @@ class Trial():
             self.reset()
             render = self.get_render()
             self.send_render(render)
-        if 'command' in message and message['command']:
-            self.handle_command(message['command'])
-        elif 'changeFrameRate' in message and message['changeFrameRate']:
-            self.handle_framerate_change(message['changeFrameRate'])
-        elif 'action' in message and message['action']:
-            print(message)
-            self.handle_action(message['action'])
+        for key, handler in self.handlers.items():
+            value = message.get(key)
+            if value:
+                handler(value)
+                break
         self.update_entry(message)
 
     def handle_command(self, command:str):
@@ -158,38 +272,28 @@ class Trial():
     def handle_framerate_change(self, change:str):
         '''
         Changes the framerate in either increments of step, or to a requested 
-        value within a minimum and maximum bound.
+        value, clamped to lie strictly between the minimum and maximum bound.
         '''
-        if not self.config.get('allowFrameRateChange'):
+        if not self.allowFrameRateChange:
             return
 
-        step = self.config.get('frameRateStepSize', 5)
-        minFR = self.config.get('minFrameRate', 1)
-        maxFR = self.config.get('maxFrameRate', 90)
-        change = change.strip().lower()
-        if change == 'faster' and self.framerate + step < maxFR:
-            self.framerate += step
-        elif change == 'slower' and self.framerate - step > minFR:
-            self.framerate -= step
+        change = str(change).strip().lower() # orjson parses numeric requests to int
+        if change in self.frameRateSteps:
+            requested = self.framerate + self.frameRateSteps[change]
         else:
             try:
                 requested = int(change)
-                if requested > minFR and requested < maxFR:
-                    self.framerate = requested
-            except:
-                pass
+            except ValueError:
+                return
+        self.framerate = min(self.maxFrameRate - 1, max(self.minFrameRate + 1, requested))
 
     def handle_action(self, action:str):
         '''
         Translates action to int and resets action buffer if action !=0
         '''
+        logging.debug('action %s', action)
         action = action.strip().lower()
-        actionSpace = self.config.get('actionSpace')
-        if action in actionSpace:
-            actionCode = actionSpace.index(action)
-        else:
-            actionCode = 0
-        self.humanAction = actionCode
+        self.humanAction = self.actionCodes.get(action, 0)
    
     def update_entry(self, update_dict:dict):
         '''
@@ -197,40 +301,88 @@ class Trial():
         '''
         self.ep_log.append(update_dict)
 
-    def get_render(self):
+    def get_render(self, encoding=None):
         '''
         Calls the Agent/Environment render function which must return a npArray.
-        Translates the npArray into a jpeg image and then base64 encodes the 
-        image for transmission in json message.
+        Translates the npArray into a jpeg image. The websocket process base64
+        encodes the image for transmission in json message.
+        If encoding is given it is the Future of a render already submitted to
+        self.encoder and its result is used instead.
         '''
-        render = self.agent.render()
         try:
-            img = Image.fromarray(render)
-            fp = BytesIO()
-            img.save(fp,'JPEG')
-            frame = base64.b64encode(fp.getvalue()).decode('utf-8')
-            fp.close()
+            if encoding:
+                frame = encoding.result()
+            else:
+                frame = self.encode_frame(self.agent.render())
         except: 
             raise TypeError("Render failed. Is env.render('rgb_array') being called\
                             With the correct arguement?")
         self.frameId += 1
         return {'frame': frame, 'frameId': self.frameId}
 
+    def encode_frame(self, render):
+        '''
+        Encodes a npArray as jpeg bytes. Uses libjpeg-turbo when available,
+        otherwise Pillow writing into a reused BytesIO buffer. Both accept
+        greyscale, RGB and RGBA renders and use 4:2:0 chroma subsampling for
+        colour and a single baseline Huffman pass at any quality.
+        The render is made C-contiguous uint8 once here, which is free for a
+        normal rgb_array, so every later stage can use its memory directly.
+        '''
+        render = numpy.ascontiguousarray(render, dtype=numpy.uint8)
+        img = self.downscale(render)
+        if self._tj:
+            if img is not None:
+                render = numpy.asarray(img)
+            if render.ndim == 2:
+                render = render[:, :, numpy.newaxis]
+            channels = render.shape[2] if render.ndim == 3 else None
+            if channels == 1:
+                return self._tj.encode(render, quality=self.jpegQuality, pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY)
+            if channels not in TJ_PIXEL_FORMATS:
+                raise TypeError(f'Render with shape {render.shape} is not greyscale, RGB or RGBA')
+            return self._tj.encode(render, quality=self.jpegQuality, pixel_format=TJ_PIXEL_FORMATS[channels], jpeg_subsample=TJSAMP_420)
+        if img is None:
+            img = to_image(render)
+        self._fp.seek(0)
+        self._fp.truncate()
+        img.save(self._fp, 'JPEG', quality=self.jpegQuality, subsampling=2, optimize=False, progressive=False)
+        return self._fp.getvalue()
+
+    def downscale(self, render):
+        '''
+        Shrinks the render so its longest side is at most maxRenderSide pixels.
+        Returns the resized PIL Image, or None if the render is already small
+        enough or maxRenderSide is not set.
+        '''
+        height, width = render.shape[:2]
+        if not self.maxRenderSide or max(height, width) <= self.maxRenderSide:
+            return None
+        scale = self.maxRenderSide / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return to_image(render).resize(size, Image.BILINEAR)
+
     def send_render(self, render:dict):
         '''
-        Attempts to send render message to websocket
+        Writes the frame into the shared FrameRing and sends its location to
+        the websocket process. Frames too large for a slot go through the pipe.
+        If binaryFrames is set the websocket sends the raw jpeg as a binary
+        message instead of base64 encoding it into json.
         '''
-        try: 
-            self.pipe.send(json.dumps(render))
-        except:
-            raise TypeError("Render Dictionary is not JSON serializable")
+        message = {'frameId': render['frameId'], 'binary': self.binaryFrames}
+        slot = self.frames.write(render['frameId'], render['frame'])
+        if slot is None:
+            message['frame'] = render['frame']
+        else:
+            message['slot'] = slot
+            message['len'] = len(render['frame'])
+        self.pipe.send(message)
 
     def send_ui(self):
-        defaultUI = ['left','right','up','down','start','pause']
-        try:
-            self.pipe.send(json.dumps({'UI': self.config.get('ui', defaultUI)}))
-        except:
-            raise TypeError("Render Dictionary is not JSON serializable")
+        '''
+        Sends the UI message, serialized once in cache_config, to websocket
+        '''
+        self.pipe.send(self.uiMessage)
 
     def take_step(self):
         '''
@@ -246,41 +398,45 @@ class Trial():
 
     def save_entry(self):
         '''
-        Either saves step memory to self.trial_log list or pickles the memory and
-        writes it to file, or both.
+        Packs the step memory of the finished episode with msgpack, appends it
+        to the outfile and clears it. This is done for both episode and trial
+        dataFile settings, a trial file simply holds one record per episode.
         Note that observation and render objects can get large, an episode can
-        have several thousand steps, holding all the steps for an episode in 
-        memory can cause performance issues if the os needs to grow the heap.
-        The program can also crash if the Server runs out of memory. 
-        It is recommended to write each step to file and not maintain it in
-        memory if the full observation is being saved.
-        comment/uncomment the below lines as desired.
-        '''
-        if self.config.get('dataFile') == 'trial':
-            self.trial_log.append(self.ep_log)
-        else:
-            cPickle.dump(self.ep_log, self.outfile)
-            self.ep_log = []
-
-    def save_record(self):
+        have several thousand steps, so only the current episode is ever held
+        in memory.
         '''
-        Saves the self.trial_log object to file. Is only called if uncommented in
-        self.end(). To record full trial records a line must also be uncommented
-        in self.save_entry() and self.create_file()
-        '''
-        cPickle.dump(self.trial_log, self.outfile)
-        self.trial_log = []
+        self.outfile.write(pack_record(self.ep_log))
+        self.ep_log = []
 
     def create_file(self):
         '''
-        Creates a file to record records to. comment/uncomment as desired 
-        for episode or full-trial logging.
+        Creates a file to record records to. With dataFile set to 'episode'
+        each episode gets its own file, with 'trial' one file is used for the
+        whole trial. If the file is already open it is kept, otherwise the
+        previous file is closed first.
+        The file is opened with a large buffer so records are written out in
+        few large writes.
         '''
-        if self.config.get('dataFile') == 'trial':
+        if self.dataFile == 'trial':
             filename = f'trial_{self.userId}'
         else:
             filename = f'episode_{self.episode}_user_{self.userId}'
+        if self.outfile and filename == self.filename:
+            return
+        self.close_file()
         path = 'Trials/'+filename
-        self.outfile = open(path, 'ab')
+        self.outfile = open(path, 'ab', buffering=1<<20)
         self.filename = filename
         self.path = path
+
+    def close_file(self):
+        '''
+        Closes the current outfile, if any, and then asks the websocket process
+        to upload it to s3 so the upload always sees the fully flushed file.
+        '''
+        if not self.outfile:
+            return
+        self.outfile.close()
+        self.outfile = None
+        if self.s3upload:
+            self.pipe.send({'upload':{'projectId':self.projectId ,'userId':self.userId,'file':self.filename,'path':self.path, 'bucket': self.bucket}})